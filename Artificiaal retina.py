@@ -1,23 +1,72 @@
 import cv2
 import numpy as np
 import time
-from collections import deque
+import math
+import queue
+import threading
+
+# Looming codes returned by dynamics_kernel
+LOOMING_STATES = ("Stationary", "APPROACHING !!!", "Receding")
+LOOMING_THRESHOLD = 50  # Area change (px) that counts as significant
+
+def dynamics_kernel(start_pos, curr_pos, n, area, avg_past_area, dt, pix_to_m):
+    """
+    Pure numeric core of the motion analysis: returns (speed, looming_code).
+    looming_code: 0 = stationary, 1 = approaching, 2 = receding.
+    """
+    # Speed = Distance / (Time elapsed for the buffer)
+    # Note: This is an estimation. For strict physics, we'd sum dt history.
+    dx = curr_pos[0] - start_pos[0]
+    dy = curr_pos[1] - start_pos[1]
+    speed = (math.hypot(dx, dy) * pix_to_m) / (dt * n)
+
+    area_delta = area - avg_past_area
+    if area_delta > LOOMING_THRESHOLD:  # Growing significantly
+        return speed, 1
+    if area_delta < -LOOMING_THRESHOLD: # Shrinking significantly
+        return speed, 2
+    return speed, 0
 
 class ArtificialRetina:
-    def __init__(self):
+    def __init__(self, show_debug=False, gray_capture=False):
         # --- BIOLOGICAL CONFIGURATION ---
         self.RETINA_W, self.RETINA_H = 320, 240  # Low res M-Pathway (Rods)
         self.MIN_AREA = 800                      # Sensitivity threshold
         self.ADAPTATION_RATE = 0.02              # Synaptic plasticity (learning rate)
         self.HISTORY_LEN = 5                     # "Short term memory" for smoothing
         self.PIXEL_TO_METER_METRIC = 0.05        # Calibration for speed
+        self.DEBUG_EVERY_N = 5                   # Ganglion view refresh interval (frames)
+        self.MAX_DECODE_FAILURES = 10            # Consecutive bad raw frames before falling back to BGR
+        self.KEY_POLL_EVERY_N = 3                # 'q' check interval when waitKey is the only option
+
+        # --- DEBUG VISUALIZATION ---
+        self.show_debug = show_debug             # Show the Ganglion Cell Layer window
+        self.frame_idx = 0
+
+        # --- CAPTURE ---
+        self.gray_capture = gray_capture         # Ask the driver for raw frames and keep only luma
 
         # --- MEMORY BUFFERS ---
         self.avg_frame = None
-        self.position_history = deque(maxlen=self.HISTORY_LEN)
-        self.area_history = deque(maxlen=self.HISTORY_LEN)
+        # Ring buffers for short term memory: _head is the next write slot, _n the fill level
+        self._pos_buf = np.zeros((self.HISTORY_LEN, 2), dtype=np.int32)
+        self._area_buf = np.zeros(self.HISTORY_LEN, dtype=np.int32)
+        self._n = 0
+        self._head = 0
         self.prev_time = time.time()
 
+        self._gray_small = np.zeros((self.RETINA_H, self.RETINA_W), dtype=np.uint8)
+        self._background_buf = np.zeros((self.RETINA_H, self.RETINA_W), dtype=np.uint8)
+        self._spike_buf = np.zeros((self.RETINA_H, self.RETINA_W), dtype=np.uint8)
+
+        # --- RECEPTIVE FIELD KERNELS ---
+        # 1D Gaussian for the inhibitory surround, applied as two separable passes
+        self.kernel_13 = cv2.getGaussianKernel(13, 0)
+        self._surround_buf = np.zeros((self.RETINA_H, self.RETINA_W), dtype=np.uint8)
+        self._dog_buf = np.zeros((self.RETINA_H, self.RETINA_W), dtype=np.uint8)
+        # One 9x9 pass == 4 iterations of the default 3x3 element
+        self.dilate_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (9, 9))
+
         print("--- ARTIFICIAL RETINA ACTIVATED ---")
         print("Mimicking: M-Pathway (Motion/Depth)")
         print("Press 'q' to sever connection.")
@@ -27,12 +76,12 @@ class ArtificialRetina:
         Simulates the Receptive Fields of the retina using Difference of Gaussians (DoG).
         This extracts edges and contrast just like biological ganglion cells.
         """
-        # Excitatory Center (Sharp)
-        g1 = cv2.GaussianBlur(gray_frame, (3, 3), 0)
-        # Inhibitory Surround (Blurry)
-        g2 = cv2.GaussianBlur(gray_frame, (13, 13), 0)
+        # Excitatory Center (Sharp) - a small-sigma blur is close to identity, so use the raw frame
+        # Inhibitory Surround (Blurry) - separable 13-tap Gaussian (2k instead of k^2 taps per pixel)
+        surround = cv2.sepFilter2D(gray_frame, cv2.CV_8U, self.kernel_13, self.kernel_13,
+                                   dst=self._surround_buf)
         # Subtract to get the "Edge/Contrast" signal
-        return cv2.subtract(g1, g2)
+        return cv2.subtract(gray_frame, surround, dst=self._dog_buf)
 
     def calculate_dynamics(self, center, area):
         """
@@ -45,90 +94,201 @@ class ArtificialRetina:
         if dt == 0: return 0, "Static"
 
         # 1. Update Short Term Memory
-        self.position_history.append(center)
-        self.area_history.append(area)
+        self._pos_buf[self._head] = center
+        self._area_buf[self._head] = area
+        self._head = (self._head + 1) % self.HISTORY_LEN
+        self._n = min(self._n + 1, self.HISTORY_LEN)
 
         # We need at least 2 frames of memory to calculate change
-        if len(self.position_history) < 2:
+        n = self._n
+        if n < 2:
             return 0, "Analyzing..."
 
         # 2. Calculate Lateral Speed (Smoothed)
         # Compare current pos with the average of recent past to reduce jitter
-        start_pos = self.position_history[0]
-        curr_pos = self.position_history[-1]
-        
-        dx = curr_pos[0] - start_pos[0]
-        dy = curr_pos[1] - start_pos[1]
-        distance_pixels = np.sqrt(dx**2 + dy**2)
-        
-        # Speed = Distance / (Time elapsed for the buffer)
-        # Note: This is an estimation. For strict physics, we'd sum dt history.
-        speed = (distance_pixels * self.PIXEL_TO_METER_METRIC) / (dt * len(self.position_history))
+        start_pos = self._pos_buf[(self._head - n) % self.HISTORY_LEN]
+        curr_pos = self._pos_buf[(self._head - 1) % self.HISTORY_LEN]
 
         # 3. Calculate Looming (Z-Axis Motion)
         # Compare recent area average vs current area
-        avg_past_area = np.mean(list(self.area_history)[:-1])
-        area_delta = area - avg_past_area
-        
-        # Thresholds for looming state
-        looming_state = "Stationary"
-        if area_delta > 50:  # Growing significantly
-            looming_state = "APPROACHING !!!"
-        elif area_delta < -50: # Shrinking significantly
-            looming_state = "Receding"
-
-        return speed, looming_state
+        # Slots [:n] are exactly the filled ones (the buffer only wraps once full)
+        avg_past_area = (self._area_buf[:n].sum() - area) / (n - 1)
+
+        speed, looming_code = dynamics_kernel(start_pos, curr_pos, n, area, avg_past_area,
+                                              dt, self.PIXEL_TO_METER_METRIC)
+        return speed, LOOMING_STATES[looming_code]
+
+    def position_trail(self):
+        """
+        Returns the remembered positions, oldest first, as an (n, 2) int32 array.
+        """
+        if self._n < self.HISTORY_LEN:
+            return self._pos_buf[:self._n]
+        return np.roll(self._pos_buf, -self._head, axis=0)
+
+    def relay_frame(self, read_q, frame, stop_event):
+        """
+        Puts a frame on the bounded queue: blocks while the cortex is busy, but stays
+        responsive to shutdown.
+        """
+        while not stop_event.is_set():
+            try:
+                read_q.put(frame, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def extract_luma(self, raw, frame_h):
+        """
+        Pulls the luma (Y) plane out of an unconverted camera frame as a 2-D uint8 image.
+        Handles YUYV (H, W, 2), planar YUV 4:2:0 (H*3/2, W), 16-bit Y16, MJPEG (encoded
+        byte buffer) and plain BGR as a fallback.
+        Returns None if the frame cannot be decoded.
+        """
+        if raw.ndim == 1 or raw.shape[0] == 1:
+            # MJPEG: empty or corrupt buffers can raise inside imdecode instead of returning None
+            if raw.size == 0: return None
+            try:
+                luma = cv2.imdecode(raw, cv2.IMREAD_GRAYSCALE)
+            except cv2.error:
+                return None
+            if luma is None: return None
+        elif raw.ndim == 3 and raw.shape[2] == 2:
+            luma = cv2.extractChannel(raw, 0)
+        elif raw.ndim == 3 and raw.shape[2] == 3:
+            luma = cv2.cvtColor(raw, cv2.COLOR_BGR2GRAY)
+        elif raw.ndim == 2:
+            # Planar YUV 4:2:0 (I420/NV12): the Y plane is the first H rows, chroma follows
+            luma = raw[:frame_h] if frame_h and raw.shape[0] == frame_h * 3 // 2 else raw
+        else:
+            return None
+
+        if luma.dtype == np.uint16:
+            luma = cv2.convertScaleAbs(luma, alpha=1 / 256) # Y16: keep the top 8 bits
+        if luma.ndim != 2 or luma.dtype != np.uint8: return None
+        return luma
+
+    def capture_photoreceptors(self, cap, read_q, stop_event):
+        """
+        Reader thread: grabs frames from the camera so decoding overlaps with processing.
+        A None frame signals the end of the stream; it is sent even if the reader fails,
+        so the main loop never waits on a dead thread.
+        """
+        frame_h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        decode_failures = 0
+        try:
+            while not stop_event.is_set():
+                ret, frame = cap.read()
+                if not ret: break
+
+                if self.gray_capture:
+                    luma = self.extract_luma(frame, frame_h)
+                    if luma is None:
+                        # Drop a corrupt frame, but give up on raw capture if nothing decodes
+                        decode_failures += 1
+                        if decode_failures >= self.MAX_DECODE_FAILURES:
+                            print("Raw frames could not be decoded, switching to BGR capture.")
+                            self.gray_capture = False
+                            cap.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+                        continue
+                    decode_failures = 0
+                    frame = luma
+
+                self.relay_frame(read_q, frame, stop_event)
+        finally:
+            self.relay_frame(read_q, None, stop_event)
 
     def process_visual_field(self):
         cap = cv2.VideoCapture(0)
+        # Keep only the newest frame in the driver so stale frames don't skew the speed estimate
+        buffer_ok = cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        print(f"Driver buffer = 1 frame: {'OK' if buffer_ok else 'unsupported by backend'}")
+        # Compressed frames use less USB bandwidth than raw YUYV
+        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+        # Grayscale-only path: skip the driver's BGR conversion, fall back if unsupported
+        if self.gray_capture and not cap.set(cv2.CAP_PROP_CONVERT_RGB, 0):
+            print("Raw capture unsupported by backend, using BGR frames.")
+            self.gray_capture = False
+
+        # Reader runs in its own thread; imshow stays on the main thread (GUI requirement)
+        read_q = queue.Queue(maxsize=2)
+        stop_event = threading.Event()
+        reader = threading.Thread(target=self.capture_photoreceptors,
+                                  args=(cap, read_q, stop_event), daemon=True)
+        reader.start()
+
+        # Retina -> screen scaling; camera resolution is fixed once streaming starts
+        scale_x = scale_y = None
+        poll_key = getattr(cv2, "pollKey", None)  # OpenCV >= 4.5
 
         while True:
-            ret, frame = cap.read()
-            if not ret: break
+            frame = read_q.get()
+            if frame is None: break
+
+            # 1. RETINAL INPUT (Grayscale & Downsample)
+            # Drop color first so the resize touches 1 channel instead of 3
+            if frame.ndim == 2:
+                gray_full = frame
+            else:
+                gray_full = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            gray = cv2.resize(gray_full, (self.RETINA_W, self.RETINA_H), dst=self._gray_small,
+                              interpolation=cv2.INTER_AREA)
+            self.frame_idx += 1
+
+            if scale_x is None:
+                scale_x = gray_full.shape[1] / self.RETINA_W
+                scale_y = gray_full.shape[0] / self.RETINA_H
 
-            # 1. RETINAL INPUT (Downsample & Grayscale)
-            small_frame = cv2.resize(frame, (self.RETINA_W, self.RETINA_H))
-            gray = cv2.cvtColor(small_frame, cv2.COLOR_BGR2GRAY)
-            
             # 2. GANGLION LAYER (Biological Edge Detection)
-            # We process the DoG image for better edge stability than raw gray
-            bio_view = self.mimic_ganglion_cells(gray)
+            # Only feeds the debug window, so refresh it every few frames when enabled
+            if self.show_debug and self.frame_idx % self.DEBUG_EVERY_N == 0:
+                bio_view = self.mimic_ganglion_cells(gray)
+                cv2.imshow("Ganglion Cell Layer (Input)", bio_view) # Visualize the biological filter
 
             # 3. SYNAPTIC ADAPTATION (Background Subtraction)
             if self.avg_frame is None:
-                self.avg_frame = gray.copy().astype("float")
+                self.avg_frame = gray.astype(np.float32)
                 continue
 
             # Update background memory (Slow adaptation)
             cv2.accumulateWeighted(gray, self.avg_frame, self.ADAPTATION_RATE)
             
             # Detect changes (Spikes)
-            frame_delta = cv2.absdiff(gray, cv2.convertScaleAbs(self.avg_frame))
-            thresh = cv2.threshold(frame_delta, 30, 255, cv2.THRESH_BINARY)[1]
-            thresh = cv2.dilate(thresh, None, iterations=4) # Dilate to merge broken blobs
+            # Every stage writes into preallocated buffers; threshold runs in place on the delta
+            background = cv2.convertScaleAbs(self.avg_frame, dst=self._background_buf)
+            frame_delta = cv2.absdiff(gray, background, dst=self._spike_buf)
+            thresh = cv2.threshold(frame_delta, 30, 255, cv2.THRESH_BINARY, dst=frame_delta)[1]
+            cv2.dilate(thresh, self.dilate_kernel, dst=thresh, iterations=1) # Dilate to merge broken blobs
 
             # 4. VISUAL CORTEX (Analysis)
-            contours, _ = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            # Label all blobs with their areas and bounding boxes in a single C call
+            num, _, stats, _ = cv2.connectedComponentsWithStats(thresh, connectivity=8)
             
             # Setup output display
-            display_frame = frame.copy()
-            
-            # Find the "Focus of Attention" (Largest Mover)
-            focus_cnt = None
-            max_area = 0
+            # Gray capture has no color frame: colorize the small retina view rather than
+            # converting the full-resolution frame, and draw the HUD in retina coords.
+            # Checked per frame since the reader may fall back to BGR mid-stream.
+            if frame.ndim == 2:
+                display_frame = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+                view_sx, view_sy = 1.0, 1.0
+            else:
+                display_frame = frame.copy()
+                view_sx, view_sy = scale_x, scale_y
             
-            for cnt in contours:
-                area = cv2.contourArea(cnt)
-                if area > self.MIN_AREA and area > max_area:
-                    max_area = area
-                    focus_cnt = cnt
+            # Find the "Focus of Attention" (Largest Mover), skipping label 0 (background)
+            focus_idx = None
+            if num > 1:
+                areas = stats[1:, cv2.CC_STAT_AREA]
+                idx = int(np.argmax(areas))
+                if areas[idx] > self.MIN_AREA:
+                    focus_idx = idx + 1
 
-            if focus_cnt is not None:
+            if focus_idx is not None:
                 # Map low-res coords to high-res screen
-                (x, y, w, h) = cv2.boundingRect(focus_cnt)
-                scale_x = frame.shape[1] / self.RETINA_W
-                scale_y = frame.shape[0] / self.RETINA_H
-                
+                x = stats[focus_idx, cv2.CC_STAT_LEFT]
+                y = stats[focus_idx, cv2.CC_STAT_TOP]
+                w = stats[focus_idx, cv2.CC_STAT_WIDTH]
+                h = stats[focus_idx, cv2.CC_STAT_HEIGHT]
                 X, Y, W, H = int(x*scale_x), int(y*scale_y), int(w*scale_x), int(h*scale_y)
                 
                 # --- CORTICAL PROCESSING ---
@@ -138,38 +298,50 @@ class ArtificialRetina:
                 speed, motion_state = self.calculate_dynamics(center_point, object_area)
 
                 # --- VISUALIZATION ---
+                vX, vY, vW, vH = int(x*view_sx), int(y*view_sy), int(w*view_sx), int(h*view_sy)
+
                 # Dynamic Color: RED = Danger (Fast/Approaching), GREEN = Safe
                 is_danger = (speed > 50 or "APPROACHING" in motion_state)
                 color = (0, 0, 255) if is_danger else (0, 255, 0)
                 
                 # Bounding Box
-                cv2.rectangle(display_frame, (X, Y), (X + W, Y + H), color, 2)
+                cv2.rectangle(display_frame, (vX, vY), (vX + vW, vY + vH), color, 2)
                 
                 # HUD Info
-                cv2.putText(display_frame, f"SPEED: {speed:.1f} u/s", (X, Y - 10), 
+                cv2.putText(display_frame, f"SPEED: {speed:.1f} u/s", (vX, vY - 10), 
                            cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
                 
                 # Looming Indicator (The "Precisely closer/away" detector)
-                cv2.putText(display_frame, f"DELTA: {motion_state}", (X, Y + H + 25), 
+                cv2.putText(display_frame, f"DELTA: {motion_state}", (vX, vY + vH + 25), 
                            cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 0), 2)
 
                 # Draw tracking trail (Retinal Persistence)
-                for i in range(1, len(self.position_history)):
-                    if self.position_history[i - 1] is None or self.position_history[i] is None: continue
-                    cv2.line(display_frame, self.position_history[i - 1], self.position_history[i], (0, 255, 255), 2)
+                trail = self.position_trail()
+                if frame.ndim == 2:
+                    trail = (trail / (scale_x, scale_y)).astype(np.int32)
+                if len(trail) > 1:
+                    cv2.polylines(display_frame, [trail.reshape(-1, 1, 2)], False, (0, 255, 255), 2)
 
             else:
                 # If no movement, clear short term memory to prevent old data influencing new objects
-                self.position_history.clear()
-                self.area_history.clear()
+                self._n = 0
+                self._head = 0
 
-            # Show the "Brain's View" vs "Retina's View"
+            # Show the "Brain's View"
             cv2.imshow("Artificial Retina (Output)", display_frame)
-            cv2.imshow("Ganglion Cell Layer (Input)", bio_view) # Visualize the biological filter
 
-            if cv2.waitKey(1) & 0xFF == ord('q'):
+            # Exit check: pollKey pumps GUI events without blocking; otherwise waitKey every few frames
+            if poll_key is not None:
+                key = poll_key()
+            elif self.frame_idx % self.KEY_POLL_EVERY_N == 0:
+                key = cv2.waitKey(1)
+            else:
+                key = -1
+            if key & 0xFF == ord('q'):
                 break
 
+        stop_event.set()
+        reader.join()
         cap.release()
         cv2.destroyAllWindows()
 